@@ -5,12 +5,13 @@
 # Lancer : streamlit run app.py
 
 import streamlit as st
-from dataclasses import dataclass, asdict
-from typing import List, Dict, Any
+from dataclasses import dataclass
+from enum import IntFlag, auto
+from typing import List, Dict, Any, Iterable, Iterator, NamedTuple, Tuple
 import datetime
 import pandas as pd
-from io import BytesIO, StringIO
-import textwrap
+from io import BytesIO
+import zipfile
 
 st.set_page_config(page_title="Diagnostic & besoins — Cabinet EC", page_icon="🧭", layout="wide")
 
@@ -26,6 +27,11 @@ HORIZON_RETRAITE = ["Loin (> 5 ans)", "À 5 ans", "< 2 ans"]
 EXPO_INTERNATIONAL = ["Aucune", "Occasionnelle", "Régulière/Structurée"]
 DEPENDANCE_CLIENT = ["Faible (<20%)", "Moyenne (20-40%)", "Forte (>40%)"]
 
+# Sous-ensembles utilisés par les règles (tests d'appartenance)
+_TAILLE_GRANDE = frozenset({"11-49", "50-249", "250+"})
+_EXPO_ACTIVE = frozenset({"Occasionnelle", "Régulière/Structurée"})
+_RETRAITE_PROCHE = frozenset({"À 5 ans", "< 2 ans"})
+
 SERVICES = {
     "social": "Service Paie & RH",
     "fiscal": "Pôle Fiscal",
@@ -37,6 +43,8 @@ SERVICES = {
     "international": "Pôle International",
     "btp": "Pôle Secteur BTP"
 }
+# Index inverse libellé → clé (routage des e-mails)
+LABEL_TO_KEY = {label: k for k, label in SERVICES.items()}
 
 # Offres indicatives (non tarifées ici ; l'outil est centré diagnostic)
 OFFRES = {
@@ -51,6 +59,9 @@ OFFRES = {
     "btp": ["Suivi chantiers", "Retenues de garantie", "Situations & DGD"]
 }
 
+# Cartographie des offres, rendue en un seul bloc Markdown (contenu statique)
+_OFFRES_MD = "".join(f"**{label}**\n\n{', '.join(OFFRES[key])}\n\n---\n\n" for key, label in SERVICES.items())
+
 DEFAULT_RECIPIENTS = {
     "social": "service-paie@cabinet.com",
     "fiscal": "pole-fiscal@cabinet.com",
@@ -70,7 +81,7 @@ ECHEANCES = ["Immédiat (≤ 3 mois)", "6-12 mois", "> 12 mois"]
 # Data Models
 # =====================================
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ClientProfile:
     nom: str
     secteur: str
@@ -94,7 +105,7 @@ class ClientProfile:
     risques_juridiques: bool
     notes: str  # notes libres
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Need:
     besoin: str
     service: str
@@ -103,192 +114,249 @@ class Need:
     impact: int
     justification: str
 
+class SwotResult(NamedTuple):
+    """Constats SWOT par bloc (le type est porté par le champ)."""
+    forces: Tuple[str, ...]
+    faiblesses: Tuple[str, ...]
+    opportunites: Tuple[str, ...]
+    menaces: Tuple[str, ...]
+
+class SwotFlag(IntFlag):
+    """Un bit par constat SWOT : les règles de besoins testent ces bits, pas les libellés."""
+    # Forces
+    DIGITAL_AVANCE = auto()
+    REPORTING_OK = auto()
+    MARGE_CONFORTABLE = auto()
+    CROISSANCE = auto()
+    # Faiblesses
+    DIGITAL_FAIBLE = auto()
+    SANS_REPORTING = auto()
+    MARGE_FAIBLE = auto()
+    TRESORERIE_TENDUE = auto()
+    # Opportunités
+    TRANSMISSION = auto()
+    PATRIMOINE = auto()
+    RSE_VALORISATION = auto()
+    EXPORT = auto()
+    # Menaces
+    EXPO_ENVIRONNEMENT = auto()
+    DEPENDANCE_CLIENT = auto()
+    RISQUES_JURIDIQUES = auto()
+    OBLIGATIONS_SOCIALES = auto()
+    COMPLEXITE_BTP = auto()
+    TVA_PLATEFORMES = auto()
+
 # =====================================
 # Helpers
 # =====================================
 
-def strength(txt: str) -> Dict[str, Any]:
-    return {"type": "Force", "texte": txt}
-
-def weakness(txt: str) -> Dict[str, Any]:
-    return {"type": "Faiblesse", "texte": txt}
+def need(besoin: str, service_key: str, priorite: str, echeance: str, impact: int, justif: str) -> Need:
+    return Need(
+        besoin=besoin,
+        service=SERVICES[service_key],
+        priorite=priorite,
+        echeance=echeance,
+        impact=impact,
+        justification=justif
+    )
 
-def opportunity(txt: str) -> Dict[str, Any]:
-    return {"type": "Opportunité", "texte": txt}
-
-def threat(txt: str) -> Dict[str, Any]:
-    return {"type": "Menace", "texte": txt}
-
-def swot_from_profile(p: ClientProfile) -> Dict[str, List[Dict[str, Any]]]:
-    F: List[Dict[str, Any]] = []
-    fbl: List[Dict[str, Any]] = []
-    O: List[Dict[str, Any]] = []
-    M: List[Dict[str, Any]] = []
+# =====================================
+# Règles (tables déclaratives ; Streamlit les reconstruit à chaque rerun,
+# l'évaluation reste derrière le cache de swot_from_profile / detect_needs)
+# =====================================
 
+# (condition sur le profil, champ de SwotResult, drapeau, libellé)
+_SWOT_RULES = (
     # Forces
-    if p.digital == "Informatique avancée":
-        F.append(strength("Digitalisation avancée (intégrations possibles)"))
-    if p.reporting_mensuel:
-        F.append(strength("Reporting financier mensuel déjà en place"))
-    if p.marge == "Confortable":
-        F.append(strength("Marge confortable"))
-    if p.croissance == "En croissance":
-        F.append(strength("Croissance du CA"))
+    (lambda p: p.digital == "Informatique avancée", "forces", SwotFlag.DIGITAL_AVANCE, "Digitalisation avancée (intégrations possibles)"),
+    (lambda p: p.reporting_mensuel, "forces", SwotFlag.REPORTING_OK, "Reporting financier mensuel déjà en place"),
+    (lambda p: p.marge == "Confortable", "forces", SwotFlag.MARGE_CONFORTABLE, "Marge confortable"),
+    (lambda p: p.croissance == "En croissance", "forces", SwotFlag.CROISSANCE, "Croissance du CA"),
 
     # Faiblesses
-    if p.digital == "Pas informatique":
-        fbl.append(weakness("Maturité digitale faible (risque d'erreurs/coûts)"))
-    if not p.reporting_mensuel:
-        fbl.append(weakness("Absence de reporting/indicateurs réguliers"))
-    if p.marge == "Faible":
-        fbl.append(weakness("Marge insuffisante / prix de revient non maîtrisé"))
-    if p.tresorerie_tendue:
-        fbl.append(weakness("Trésorerie tendue / pas de prévisionnel"))
+    (lambda p: p.digital == "Pas informatique", "faiblesses", SwotFlag.DIGITAL_FAIBLE, "Maturité digitale faible (risque d'erreurs/coûts)"),
+    (lambda p: not p.reporting_mensuel, "faiblesses", SwotFlag.SANS_REPORTING, "Absence de reporting/indicateurs réguliers"),
+    (lambda p: p.marge == "Faible", "faiblesses", SwotFlag.MARGE_FAIBLE, "Marge insuffisante / prix de revient non maîtrisé"),
+    (lambda p: p.tresorerie_tendue, "faiblesses", SwotFlag.TRESORERIE_TENDUE, "Trésorerie tendue / pas de prévisionnel"),
 
     # Opportunités
-    if p.proche_retraite in ("À 5 ans", "< 2 ans"):
-        O.append(opportunity("Préparer la transmission / retraite dirigeant"))
-    if p.patrimoine_dirigeant_important:
-        O.append(opportunity("Optimisation patrimoniale (holding/SCI/PEA-PME, etc.)"))
-    if p.rse_sensible:
-        O.append(opportunity("Valorisation via la démarche RSE / CSRD adaptée"))
-    if p.exposition_internationale in ("Occasionnelle", "Régulière/Structurée"):
-        O.append(opportunity("Développement export / structuration internationale"))
+    (lambda p: p.proche_retraite in _RETRAITE_PROCHE, "opportunites", SwotFlag.TRANSMISSION, "Préparer la transmission / retraite dirigeant"),
+    (lambda p: p.patrimoine_dirigeant_important, "opportunites", SwotFlag.PATRIMOINE, "Optimisation patrimoniale (holding/SCI/PEA-PME, etc.)"),
+    (lambda p: p.rse_sensible, "opportunites", SwotFlag.RSE_VALORISATION, "Valorisation via la démarche RSE / CSRD adaptée"),
+    (lambda p: p.exposition_internationale in _EXPO_ACTIVE, "opportunites", SwotFlag.EXPORT, "Développement export / structuration internationale"),
 
     # Menaces
-    if p.impact_env == "Importante":
-        M.append(threat("Exposition réglementaire environnementale élevée"))
-    if p.dependance_client == "Forte (>40%)":
-        M.append(threat("Dépendance à un client majeur"))
-    if p.risques_juridiques:
-        M.append(threat("Litiges / risques juridiques non traités"))
-    if p.taille in ("11-49", "50-249", "250+") and not p.presence_cadres:
-        M.append(threat("Obligations sociales renforcées sans structuration RH"))
+    (lambda p: p.impact_env == "Importante", "menaces", SwotFlag.EXPO_ENVIRONNEMENT, "Exposition réglementaire environnementale élevée"),
+    (lambda p: p.dependance_client == "Forte (>40%)", "menaces", SwotFlag.DEPENDANCE_CLIENT, "Dépendance à un client majeur"),
+    (lambda p: p.risques_juridiques, "menaces", SwotFlag.RISQUES_JURIDIQUES, "Litiges / risques juridiques non traités"),
+    (lambda p: p.taille in _TAILLE_GRANDE and not p.presence_cadres, "menaces", SwotFlag.OBLIGATIONS_SOCIALES, "Obligations sociales renforcées sans structuration RH"),
 
     # Secteur/Spécifiques
-    if p.secteur == "BTP" or p.btp_specifique:
-        M.append(threat("Complexité BTP (retenues, situations, DGD)"))
-    if p.ecommerce_plateformes:
-        M.append(threat("TVA plateformes / marketplace (OSS/IOSS)"))
-
-    return {"Forces": F, "Faiblesses": fbl, "Opportunités": O, "Menaces": M}
-
-def detect_needs(p: ClientProfile, swot: Dict[str, List[Dict[str, Any]]]) -> List[Need]:
-    needs: List[Need] = []
-
-    def add(besoin: str, service_key: str, priorite: str, echeance: str, impact: int, justif: str):
-        needs.append(Need(
-            besoin=besoin,
-            service=SERVICES[service_key],
-            priorite=priorite,
-            echeance=echeance,
-            impact=impact,
-            justification=justif
-        ))
+    (lambda p: p.secteur == "BTP" or p.btp_specifique, "menaces", SwotFlag.COMPLEXITE_BTP, "Complexité BTP (retenues, situations, DGD)"),
+    (lambda p: p.ecommerce_plateformes, "menaces", SwotFlag.TVA_PLATEFORMES, "TVA plateformes / marketplace (OSS/IOSS)"),
+)
 
+# (condition sur profil + drapeaux SWOT, besoin)
+_NEED_RULES = (
     # Règles issues des faiblesses/menaces
-    fb_texts = [x["texte"] for x in swot.get("Faiblesses", [])]
-    m_texts = [x["texte"] for x in swot.get("Menaces", [])]
-
-    if "Maturité digitale faible (risque d'erreurs/coûts)" in fb_texts:
-        add("Cartographie & plan de digitalisation", "digital", "Moyenne", "6-12 mois", 3, "Digitalisation faible détectée")
-    if "Absence de reporting/indicateurs réguliers" in fb_texts:
-        add("Mise en place de tableaux de bord mensuels", "gestion", "Haute", "Immédiat (≤ 3 mois)", 4, "Absence de pilotage mensuel")
-    if "Marge insuffisante / prix de revient non maîtrisé" in fb_texts:
-        add("Étude prix de revient & politique de pricing", "eco_strat", "Haute", "Immédiat (≤ 3 mois)", 5, "Marge insuffisante")
-    if "Trésorerie tendue / pas de prévisionnel" in fb_texts:
-        add("Prévisionnel & cash management", "gestion", "Haute", "Immédiat (≤ 3 mois)", 5, "Tension de trésorerie")
-
-    if "Exposition réglementaire environnementale élevée" in m_texts or p.rse_sensible:
-        add("Diagnostic RSE & plan d'actions", "rse", "Moyenne", "6-12 mois", 3, "Enjeux RSE / environnementaux")
-    if "Dépendance à un client majeur" in m_texts:
-        add("Plan de diversification commerciale", "eco_strat", "Moyenne", "6-12 mois", 4, "Risque de dépendance client")
-    if "Complexité BTP (retenues, situations, DGD)" in m_texts:
-        add("Mise en place suivi chantiers / DGD", "btp", "Moyenne", "6-12 mois", 3, "Spécificités BTP")
-    if "TVA plateformes / marketplace (OSS/IOSS)" in m_texts:
-        add("Revue TVA (OSS/IOSS) & procédures", "international", "Haute", "Immédiat (≤ 3 mois)", 4, "Risque TVA marketplaces")
+    (lambda p, f: f & SwotFlag.DIGITAL_FAIBLE,
+     need("Cartographie & plan de digitalisation", "digital", "Moyenne", "6-12 mois", 3, "Digitalisation faible détectée")),
+    (lambda p, f: f & SwotFlag.SANS_REPORTING,
+     need("Mise en place de tableaux de bord mensuels", "gestion", "Haute", "Immédiat (≤ 3 mois)", 4, "Absence de pilotage mensuel")),
+    (lambda p, f: f & SwotFlag.MARGE_FAIBLE,
+     need("Étude prix de revient & politique de pricing", "eco_strat", "Haute", "Immédiat (≤ 3 mois)", 5, "Marge insuffisante")),
+    (lambda p, f: f & SwotFlag.TRESORERIE_TENDUE,
+     need("Prévisionnel & cash management", "gestion", "Haute", "Immédiat (≤ 3 mois)", 5, "Tension de trésorerie")),
+
+    (lambda p, f: f & SwotFlag.EXPO_ENVIRONNEMENT or p.rse_sensible,
+     need("Diagnostic RSE & plan d'actions", "rse", "Moyenne", "6-12 mois", 3, "Enjeux RSE / environnementaux")),
+    (lambda p, f: f & SwotFlag.DEPENDANCE_CLIENT,
+     need("Plan de diversification commerciale", "eco_strat", "Moyenne", "6-12 mois", 4, "Risque de dépendance client")),
+    (lambda p, f: f & SwotFlag.COMPLEXITE_BTP,
+     need("Mise en place suivi chantiers / DGD", "btp", "Moyenne", "6-12 mois", 3, "Spécificités BTP")),
+    (lambda p, f: f & SwotFlag.TVA_PLATEFORMES,
+     need("Revue TVA (OSS/IOSS) & procédures", "international", "Haute", "Immédiat (≤ 3 mois)", 4, "Risque TVA marketplaces")),
 
     # Opportunités
-    if any("Préparer la transmission / retraite dirigeant" in x["texte"] for x in swot.get("Opportunités", [])):
-        add("Bilan retraite & pré-étude de transmission", "patrimonial", "Moyenne", "6-12 mois", 3, "Fenêtre d'opportunité transmission")
-    if any("Optimisation patrimoniale" in x["texte"] for x in swot.get("Opportunités", [])):
-        add("Bilan patrimonial dirigeant", "patrimonial", "Moyenne", "6-12 mois", 3, "Patrimoine dirigeant important")
-    if any("Développement export" in x["texte"] for x in swot.get("Opportunités", [])):
-        add("Diagnostic international (TVA / flux / implantations)", "international", "Moyenne", "6-12 mois", 3, "Opportunité export")
-    if any("Valorisation via la démarche RSE" in x["texte"] for x in swot.get("Opportunités", [])):
-        add("Reporting extra-financier simplifié", "rse", "Basse", "> 12 mois", 2, "Créer de la valeur via RSE")
+    (lambda p, f: f & SwotFlag.TRANSMISSION,
+     need("Bilan retraite & pré-étude de transmission", "patrimonial", "Moyenne", "6-12 mois", 3, "Fenêtre d'opportunité transmission")),
+    (lambda p, f: f & SwotFlag.PATRIMOINE,
+     need("Bilan patrimonial dirigeant", "patrimonial", "Moyenne", "6-12 mois", 3, "Patrimoine dirigeant important")),
+    (lambda p, f: f & SwotFlag.EXPORT,
+     need("Diagnostic international (TVA / flux / implantations)", "international", "Moyenne", "6-12 mois", 3, "Opportunité export")),
+    (lambda p, f: f & SwotFlag.RSE_VALORISATION,
+     need("Reporting extra-financier simplifié", "rse", "Basse", "> 12 mois", 2, "Créer de la valeur via RSE")),
 
     # Social / RH (induit par taille/obligations)
-    if p.taille in ("11-49", "50-249", "250+"):
-        if not p.presence_cadres:
-            add("Audit social & mise en conformité (CSE, DUERP...)", "social", "Haute", "Immédiat (≤ 3 mois)", 4, "Obligations sociales renforcées")
-        else:
-            add("Optimisation processus paie/RH", "social", "Moyenne", "6-12 mois", 3, "Effectif significatif")
+    (lambda p, f: f & SwotFlag.OBLIGATIONS_SOCIALES,
+     need("Audit social & mise en conformité (CSE, DUERP...)", "social", "Haute", "Immédiat (≤ 3 mois)", 4, "Obligations sociales renforcées")),
+    (lambda p, f: p.taille in _TAILLE_GRANDE and p.presence_cadres,
+     need("Optimisation processus paie/RH", "social", "Moyenne", "6-12 mois", 3, "Effectif significatif")),
 
     # Fiscal — détection via ecommerce/international
-    if p.ecommerce_plateformes or p.exposition_internationale in ("Occasionnelle", "Régulière/Structurée"):
-        add("Revue fiscale ciblée (TVA, prix de transfert simplifiés)", "fiscal", "Moyenne", "6-12 mois", 3, "Flux e-commerce/internationaux")
+    (lambda p, f: p.ecommerce_plateformes or p.exposition_internationale in _EXPO_ACTIVE,
+     need("Revue fiscale ciblée (TVA, prix de transfert simplifiés)", "fiscal", "Moyenne", "6-12 mois", 3, "Flux e-commerce/internationaux")),
 
     # Gestion — si nb de banques > 1, reporting absent ou trésorerie tendue
-    if (p.nb_banques > 1 and not p.reporting_mensuel) or p.tresorerie_tendue:
-        add("Centralisation banques & rapprochements automatiques", "digital", "Moyenne", "6-12 mois", 3, "Multiples banques sans process outillé")
+    (lambda p, f: (p.nb_banques > 1 and not p.reporting_mensuel) or p.tresorerie_tendue,
+     need("Centralisation banques & rapprochements automatiques", "digital", "Moyenne", "6-12 mois", 3, "Multiples banques sans process outillé")),
 
     # Éco/Stratégie — croissance, marge, dépendance
-    if p.croissance in ("En baisse", "Stable") and p.marge != "Confortable":
-        add("Diagnostic stratégique (marché/offre/organisation)", "eco_strat", "Moyenne", "6-12 mois", 4, "Performance perfectible")
+    (lambda p, f: p.croissance in ("En baisse", "Stable") and p.marge != "Confortable",
+     need("Diagnostic stratégique (marché/offre/organisation)", "eco_strat", "Moyenne", "6-12 mois", 4, "Performance perfectible")),
+)
 
+# =====================================
+# Moteur de diagnostic
+# =====================================
+
+@st.cache_data(ttl=3600, max_entries=256)
+def swot_from_profile(p: ClientProfile) -> Tuple[int, SwotResult]:
+    """Renvoie (drapeaux SwotFlag cumulés, libellés par bloc pour l'affichage)."""
+    flags = 0
+    out: Dict[str, List[str]] = {field: [] for field in SwotResult._fields}
+    for pred, field, flag, texte in _SWOT_RULES:
+        if pred(p):
+            flags |= flag
+            out[field].append(texte)
+    return int(flags), SwotResult(**{field: tuple(v) for field, v in out.items()})
+
+@st.cache_data(ttl=3600, max_entries=256)
+def detect_needs(p: ClientProfile, flags: int) -> List[Need]:
     # Déduplication & consolidation
     unique = []
     seen = set()
-    for n in needs:
+    for pred, n in _NEED_RULES:
+        if not pred(p, flags):
+            continue
         key = (n.besoin, n.service)
         if key not in seen:
             unique.append(n)
             seen.add(key)
     return unique
 
-def needs_to_dataframe(needs: List[Need]) -> pd.DataFrame:
-    data = [asdict(n) for n in needs]
-    df = pd.DataFrame(data)
-    if not df.empty:
-        df["Envoyer ?"] = True
-    else:
-        df = pd.DataFrame(columns=["besoin","service","priorite","echeance","impact","justification","Envoyer ?"])
-    return df
-
-def make_email(service_email: str, client_name: str, row: Dict[str, Any]) -> Dict[str, Any]:
-    subject = f"[DIAG] {client_name} — {row['besoin']} ({row['priorite']}, {row['echeance']})"
-    body_lines = [
-        f"Service concerné : {row['service']}",
-        f"Client : {client_name}",
-        f"Besoin : {row['besoin']}",
-        f"Priorité : {row['priorite']} | Échéance : {row['echeance']} | Impact : {row['impact']}/5",
-        f"Justification : {row['justification']}",
-        "",
-        "Merci de revenir vers le chargé de dossier pour planifier la prise en charge."
+_NEED_COLS = ["besoin","service","priorite","echeance","impact","justification"]
+
+def needs_to_rows(needs: List[Need]) -> List[Dict[str, Any]]:
+    # Tableau de quelques lignes : liste de dicts, acceptée (et renvoyée) telle quelle par st.data_editor
+    return [
+        {"besoin": n.besoin, "service": n.service, "priorite": n.priorite, "echeance": n.echeance,
+         "impact": n.impact, "justification": n.justification, "Envoyer ?": True}
+        for n in needs
     ]
-    body = "\n".join(body_lines)
-    # .eml minimal (brouillon local)
-    eml = textwrap.dedent(f"""\
-    From: diagnostic@cabinet.com
-    To: {service_email}
-    Subject: {subject}
-    MIME-Version: 1.0
-    Content-Type: text/plain; charset=UTF-8
-
-    {body}
-    """)
-    return {"to": service_email, "subject": subject, "body": body, "eml": eml}
-
-def zip_emails(emails: List[Dict[str, Any]], client_name: str) -> bytes:
-    import zipfile
+
+# Modèles d'e-mail (chaînes sans indentation, .eml minimal = brouillon local)
+_BODY_TMPL = (
+    "Service concerné : {service}\n"
+    "Client : {client}\n"
+    "Besoin : {besoin}\n"
+    "Priorité : {priorite} | Échéance : {echeance} | Impact : {impact}/5\n"
+    "Justification : {justification}\n"
+    "\n"
+    "Merci de revenir vers le chargé de dossier pour planifier la prise en charge."
+)
+_EML_TMPL = (
+    "From: diagnostic@cabinet.com\n"
+    "To: {to}\n"
+    "Subject: {subject}\n"
+    "MIME-Version: 1.0\n"
+    "Content-Type: text/plain; charset=UTF-8\n"
+    "\n"
+    "{body}\n"
+)
+_SUBJECT_TMPL = "[DIAG] {client} — {besoin} ({priorite}, {echeance})"
+
+def service_email(label: str, recipients: Dict[str, str]) -> str:
+    key = LABEL_TO_KEY.get(label)
+    return recipients.get(key) or DEFAULT_RECIPIENTS.get(key, "info@cabinet.com")
+
+def iter_emails(to_send: List[Dict[str, Any]], recipients: Dict[str, str], client_name: str) -> Iterator[Tuple[str, str]]:
+    """Produit (nom de fichier, contenu .eml) au fil de l'eau, sans liste intermédiaire."""
+    slug = client_name.replace(' ','_')
+    for i, row in enumerate(to_send, start=1):
+        subject = _SUBJECT_TMPL.format(client=client_name, **row)
+        body = _BODY_TMPL.format(client=client_name, **row)
+        yield f"{i:02d}_{slug}.eml", _EML_TMPL.format(to=service_email(row["service"], recipients), subject=subject, body=body)
+
+def zip_emails(emails: Iterable[Tuple[str, str]]) -> Tuple[bytes, str]:
+    """Écrit les .eml directement dans le ZIP ; renvoie (zip, dernier .eml pour l'aperçu)."""
     tmp = BytesIO()
-    with zipfile.ZipFile(tmp, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for i, em in enumerate(emails, start=1):
-            filename = f"{i:02d}_{client_name.replace(' ','_')}.eml"
-            zf.writestr(filename, em["eml"])
-    tmp.seek(0)
-    return tmp.read()
+    last_eml = ""
+    # .eml de quelques centaines d'octets : pas de compression (ZIP_STORED)
+    with zipfile.ZipFile(tmp, mode="w", compression=zipfile.ZIP_STORED) as zf:
+        for filename, eml in emails:
+            zf.writestr(filename, eml)
+            last_eml = eml
+    return tmp.getvalue(), last_eml
+
+# Exports mis en cache : re-sérialisés seulement si le tableau / le diagnostic changent
+
+@st.cache_data
+def to_csv_bytes(rows: List[Dict[str, Any]]) -> bytes:
+    # pandas n'est sollicité que pour la sérialisation CSV ; encodé une fois, réutilisé tel quel
+    return pd.DataFrame(rows, columns=_NEED_COLS + ["Envoyer ?"]).to_csv(index=False).encode("utf-8")
+
+@st.cache_data(ttl=86400)
+def build_markdown(client_name: str, swot: SwotResult, edited: List[Dict[str, Any]], day_iso: str) -> str:
+    # day_iso fait partie de la clé de cache : la synthèse reste datée du jour
+    md_lines = [f"# Diagnostic & besoins — {client_name}", "", f"_Date : {day_iso}_", ""]
+    md_lines.append("## SWOT (orienté besoins)")
+    for bloc, textes in zip(("Forces","Faiblesses","Opportunités","Menaces"), swot):
+        md_lines.append(f"### {bloc}")
+        if textes:
+            for texte in textes:
+                md_lines.append(f"- {texte}")
+        else:
+            md_lines.append("- (néant)")
+        md_lines.append("")
+    md_lines.append("## Besoins & rattachement services")
+    if edited:
+        for row in edited:
+            md_lines.append(f"- **{row['besoin']}** → _{row['service']}_ — **{row['priorite']}**, {row['echeance']} (impact {row['impact']}/5)")
+            md_lines.append(f"  - Justification : {row['justification']}")
+    else:
+        md_lines.append("- (aucun)")
+    return "\n".join(md_lines)
 
 # =====================================
 # UI — Paramètres & profil
@@ -299,33 +367,37 @@ st.caption("Structure SWOT adaptée → détection de besoins → rattachement s
 
 with st.sidebar:
     st.header("📂 Dossier client")
-    nom = st.text_input("Nom du client / dossier", "Client DEMO")
-    secteur = st.selectbox("Secteur", SECTEURS, index=2)
-    taille = st.selectbox("Taille", TAILLE, index=1)
-    digital = st.selectbox("Maturité digitale", DIGITAL, index=1)
-    impact_env = st.selectbox("Impact environnemental", IMPACT_ENV, index=0)
-    rse_sensible = st.toggle("Sensible RSE", value=False)
-    presence_cadres = st.toggle("Présence de cadres / RH structuré", value=False)
-    exposition_internationale = st.selectbox("Exposition internationale", EXPO_INTERNATIONAL, index=0)
-    dependance_client = st.selectbox("Dépendance à un client", DEPENDANCE_CLIENT, index=0)
-    croissance = st.selectbox("Tendance d'activité", ["En baisse","Stable","En croissance"], index=1)
-    marge = st.selectbox("Niveau de marge", ["Faible","Correcte","Confortable"], index=1)
-    tresorerie_tendue = st.toggle("Trésorerie tendue", value=False)
-    reporting_mensuel = st.toggle("Reporting mensuel en place", value=False)
-    nb_banques = st.number_input("Nombre de banques actives", min_value=0, max_value=20, value=1, step=1)
-    proche_retraite = st.selectbox("Horizon retraite dirigeant", HORIZON_RETRAITE, index=0)
-    succession_envisagee = st.toggle("Projet de succession / transmission", value=False)
-    patrimoine_dirigeant_important = st.toggle("Patrimoine dirigeant important", value=False)
-    btp_specifique = st.toggle("Spécificités BTP", value=(secteur=="BTP"))
-    ecommerce_plateformes = st.toggle("E-commerce via plateformes", value=False)
-    risques_juridiques = st.toggle("Risques juridiques/litiges", value=False)
-    notes = st.text_area("Notes libres", "")
+    # Formulaire : les saisies ne déclenchent un rerun qu'à la validation
+    with st.form("profile", clear_on_submit=False):
+        nom = st.text_input("Nom du client / dossier", "Client DEMO")
+        secteur = st.selectbox("Secteur", SECTEURS, index=2)
+        taille = st.selectbox("Taille", TAILLE, index=1)
+        digital = st.selectbox("Maturité digitale", DIGITAL, index=1)
+        impact_env = st.selectbox("Impact environnemental", IMPACT_ENV, index=0)
+        rse_sensible = st.toggle("Sensible RSE", value=False)
+        presence_cadres = st.toggle("Présence de cadres / RH structuré", value=False)
+        exposition_internationale = st.selectbox("Exposition internationale", EXPO_INTERNATIONAL, index=0)
+        dependance_client = st.selectbox("Dépendance à un client", DEPENDANCE_CLIENT, index=0)
+        croissance = st.selectbox("Tendance d'activité", ["En baisse","Stable","En croissance"], index=1)
+        marge = st.selectbox("Niveau de marge", ["Faible","Correcte","Confortable"], index=1)
+        tresorerie_tendue = st.toggle("Trésorerie tendue", value=False)
+        reporting_mensuel = st.toggle("Reporting mensuel en place", value=False)
+        nb_banques = st.number_input("Nombre de banques actives", min_value=0, max_value=20, value=1, step=1)
+        proche_retraite = st.selectbox("Horizon retraite dirigeant", HORIZON_RETRAITE, index=0)
+        succession_envisagee = st.toggle("Projet de succession / transmission", value=False)
+        patrimoine_dirigeant_important = st.toggle("Patrimoine dirigeant important", value=False)
+        btp_specifique = st.toggle("Spécificités BTP", value=False)
+        ecommerce_plateformes = st.toggle("E-commerce via plateformes", value=False)
+        risques_juridiques = st.toggle("Risques juridiques/litiges", value=False)
+        notes = st.text_area("Notes libres", "")
+        st.form_submit_button("Diagnostiquer", type="primary", use_container_width=True)
 
     st.markdown("---")
     st.subheader("📧 Routage des services")
-    recipients = {}
+    # Valeurs conservées par Streamlit via key= ; initialisées une seule fois par session
     for k, label in SERVICES.items():
-        recipients[k] = st.text_input(f"Email — {label}", value=DEFAULT_RECIPIENTS[k])
+        st.session_state.setdefault(f"recip_{k}", DEFAULT_RECIPIENTS[k])
+        st.text_input(f"Email — {label}", key=f"recip_{k}")
 
 profile = ClientProfile(
     nom=nom,
@@ -355,57 +427,62 @@ profile = ClientProfile(
 # Diagnostic & besoins
 # =====================================
 
-swot = swot_from_profile(profile)
+flags, swot = swot_from_profile(profile)
 
 c1, c2 = st.columns(2)
 with c1:
     st.subheader("✅ Forces")
-    if swot["Forces"]:
-        for x in swot["Forces"]:
-            st.success(x["texte"])
+    if swot.forces:
+        for texte in swot.forces:
+            st.success(texte)
     else:
         st.info("Aucune force saillante identifiée pour l'instant.")
 
     st.subheader("🚀 Opportunités")
-    if swot["Opportunités"]:
-        for x in swot["Opportunités"]:
-            st.info(x["texte"])
+    if swot.opportunites:
+        for texte in swot.opportunites:
+            st.info(texte)
     else:
         st.caption("Complétez les informations pour faire émerger des opportunités.")
 
 with c2:
     st.subheader("⚠️ Faiblesses")
-    if swot["Faiblesses"]:
-        for x in swot["Faiblesses"]:
-            st.warning(x["texte"])
+    if swot.faiblesses:
+        for texte in swot.faiblesses:
+            st.warning(texte)
     else:
         st.caption("Rien de critique détecté à ce stade.")
 
     st.subheader("⛔ Menaces")
-    if swot["Menaces"]:
-        for x in swot["Menaces"]:
-            st.error(x["texte"])
+    if swot.menaces:
+        for texte in swot.menaces:
+            st.error(texte)
     else:
         st.caption("Pas de menace majeure détectée.")
 
 st.divider()
 
 st.subheader("🎯 Besoins détectés (éditables)")
-needs = detect_needs(profile, swot)
-df = needs_to_dataframe(needs)
-
-edited = st.data_editor(
-    df,
-    use_container_width=True,
-    disabled=[],
-    column_config={
-        "priorite": st.column_config.SelectboxColumn("Priorité", options=PRIORITES, required=True),
-        "echeance": st.column_config.SelectboxColumn("Échéance", options=ECHEANCES, required=True),
-        "impact": st.column_config.NumberColumn("Impact (1-5)", min_value=1, max_value=5, step=1),
-        "Envoyer ?": st.column_config.CheckboxColumn("Envoyer ?", default=True)
-    },
-    num_rows="fixed"
-)
+needs = detect_needs(profile, flags)
+rows = needs_to_rows(needs)
+
+if rows:
+    edited = st.data_editor(
+        rows,
+        use_container_width=True,
+        disabled=[],
+        column_config={
+            "priorite": st.column_config.SelectboxColumn("Priorité", options=PRIORITES, required=True),
+            "echeance": st.column_config.SelectboxColumn("Échéance", options=ECHEANCES, required=True),
+            "impact": st.column_config.NumberColumn("Impact (1-5)", min_value=1, max_value=5, step=1),
+            "Envoyer ?": st.column_config.CheckboxColumn("Envoyer ?", default=True)
+        },
+        num_rows="fixed"
+    )
+else:
+    # Liste vide : st.data_editor n'aurait aucune colonne à afficher
+    edited = []
+    st.caption("Aucun besoin détecté pour ce profil.")
 
 st.markdown("**Astuce :** ajustez priorités/échéances avant de générer les événements.")
 
@@ -415,65 +492,31 @@ colA, colB, colC = st.columns([1,1,1])
 
 with colA:
     st.subheader("📤 Export besoins")
-    csv_buf = StringIO()
-    edited.to_csv(csv_buf, index=False)
-    st.download_button("Télécharger CSV des besoins", data=csv_buf.getvalue(), file_name=f"besoins_{profile.nom.replace(' ','_')}.csv", mime="text/csv")
+    st.download_button("Télécharger CSV des besoins", data=to_csv_bytes(edited), file_name=f"besoins_{profile.nom.replace(' ','_')}.csv", mime="text/csv")
 
 with colB:
     st.subheader("🧾 Synthèse Markdown")
-    md_lines = [f"# Diagnostic & besoins — {profile.nom}", "", f"_Date : {datetime.date.today().isoformat()}_", ""]
-    md_lines.append("## SWOT (orienté besoins)")
-    for bloc in ("Forces","Faiblesses","Opportunités","Menaces"):
-        md_lines.append(f"### {bloc}")
-        if swot[bloc]:
-            for x in swot[bloc]:
-                md_lines.append(f"- {x['texte']}")
-        else:
-            md_lines.append("- (néant)")
-        md_lines.append("")
-    md_lines.append("## Besoins & rattachement services")
-    if not edited.empty:
-        for _, row in edited.iterrows():
-            md_lines.append(f"- **{row['besoin']}** → _{row['service']}_ — **{row['priorite']}**, {row['echeance']} (impact {row['impact']}/5)")
-            md_lines.append(f"  - Justification : {row['justification']}")
-    else:
-        md_lines.append("- (aucun)")
-    md = "\n".join(md_lines)
+    md = build_markdown(profile.nom, swot, edited, datetime.date.today().isoformat())
     st.download_button("Télécharger la synthèse (.md)", data=md, file_name=f"diagnostic_{profile.nom.replace(' ','_')}.md", mime="text/markdown")
 
 with colC:
     st.subheader("✉️ Générer les e-mails")
-    to_send = edited[edited["Envoyer ?"] == True] if not edited.empty else edited
-    if to_send.empty:
+    to_send = [row for row in edited if row.get("Envoyer ?")]
+    if not to_send:
         st.caption("Cochez au moins un besoin à envoyer.")
     else:
-        emails: List[Dict[str, Any]] = []
-        for _, row in to_send.iterrows():
-            # retrouver la clé service inverse pour email routing
-            svc_email = None
-            for key, label in SERVICES.items():
-                if label == row["service"]:
-                    svc_email = recipients.get(key, DEFAULT_RECIPIENTS[key])
-                    break
-            if not svc_email:
-                svc_email = "info@cabinet.com"
-            em = make_email(svc_email, profile.nom, row.to_dict())
-            emails.append(em)
-
-        # ZIP .eml
-        zip_bytes = zip_emails(emails, profile.nom)
+        # ZIP .eml (écriture en flux)
+        recipients = {k: st.session_state[f"recip_{k}"] for k in SERVICES}
+        zip_bytes, last_eml = zip_emails(iter_emails(to_send, recipients, profile.nom))
         st.download_button("Télécharger .zip des brouillons d'e-mails (.eml)", data=zip_bytes, file_name=f"emails_{profile.nom.replace(' ','_')}.zip", mime="application/zip")
 
         # Aperçu du dernier email
         with st.expander("Aperçu d'un e-mail (dernier généré)"):
-            st.code(emails[-1]["eml"], language="eml")
+            st.code(last_eml, language="eml")
 
 st.divider()
 with st.expander("📚 Cartographie offres internes (référence)"):
     st.write("Ci-dessous, les offres indicatives par service pour orienter la réponse :")
-    for key, label in SERVICES.items():
-        st.markdown(f"**{label}**")
-        st.write(", ".join(OFFRES[key]))
-        st.markdown("---")
+    st.markdown(_OFFRES_MD)
 
 st.caption("💡 Cet outil est centré sur le diagnostic. Les prix, si souhaités, peuvent être gérés ailleurs. Ajoutez vos règles métier et modèles d'e-mails propres au cabinet.")